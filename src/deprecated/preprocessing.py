@@ -1,12 +1,24 @@
-import xml.etree.ElementTree as ET
+import html
+import lxml.etree as ET
 import requests
+import shutil
 from pathlib import Path
-import json
-import html
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
-import warnings
+import mmap
+import orjson
+from lxml import html as lxml_html
+
+# Precompiled XPath expressions for parse_project()
+XP_ARCHIVE = ET.XPath("ProjectID/ArchiveID")
+XP_DESCR = ET.XPath("ProjectDescr")
+XP_PUBLICATION = ET.XPath(".//Publication")
+XP_ORGANISM = ET.XPath(".//OrganismName")
+XP_DISEASE = ET.XPath(".//Disease")
 
-warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
+
+def find(xpath, elem):
+    """Same as elem.find(), with a precompiled XPath"""
+    matches = xpath(elem)
+    return matches[0] if matches else None
 
 
 def download_bioprojects(output="./bioprojects-rag-data/bioproject.xml"):
@@ -20,32 +32,37 @@ def download_bioprojects(output="./bioprojects-rag-data/bioproject.xml"):
     else:
         print(f"Downloading {output}")
         url = "https://ftp.ncbi.nlm.nih.gov/bioproject/bioproject.xml"
-        response = requests.get(url)
-        response.raise_for_status()
-        with open(output, "wb") as fh:
-            fh.write(response.content)
+        # Stream to disk, the file does not fit in memory
+        with requests.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(output, "wb") as fh:
+                shutil.copyfileobj(response.raw, fh, length=1 << 20)
     return output
 
 
 def parse_project(elem):
     """Extract all relevant information from a <Project> element into a dict."""
     # Project identifiers
-    archive = elem.find("ProjectID/ArchiveID")
+    archive = find(XP_ARCHIVE, elem)
     accession = archive.get("accession") if archive is not None else None
 
     # Basic description
-    descr = elem.find("ProjectDescr")
+    descr = find(XP_DESCR, elem)
     name = descr.findtext("Name") if descr is not None else None
     title = descr.findtext("Title") if descr is not None else None
     description = descr.findtext("Description") if descr is not None else None
-    if description:
-        description = html.unescape(description)
-        soup = BeautifulSoup(description, "html.parser")
-        description = soup.get_text(separator=" ", strip=True)
+    if description and ("<" in description or "&" in description):
+        # Strip HTML markup and entities (also doubly-escaped markup), plain text descriptions skip the HTML parser
+        # Parsed as a fragment: descriptions without any text (e.g. only a comment) give ""
+        fragment = lxml_html.fragment_fromstring(html.unescape(description), create_parent="div")
+        description = " ".join(text.strip() for text in fragment.itertext() if text.strip())
+    elif description:
+        description = description.strip()
 
     # Publications
     publications = []
-    for pub in elem.findall(".//Publication"):
+    for pub in XP_PUBLICATION(elem):
         citation = pub.find("StructuredCitation")
         publications.append({
             "title": citation.findtext("Title") if citation is not None else None,
@@ -54,9 +71,10 @@ def parse_project(elem):
         })
 
     # Organism info
-    organism = elem.findtext(".//OrganismName")
+    organism = find(XP_ORGANISM, elem)
+    organism = (organism.text or "") if organism is not None else None
 
-    diseases = [x.text for x in elem.findall(".//Disease")]
+    diseases = [x.text for x in XP_DISEASE(elem)]
 
     return {
         "accession": accession,
@@ -72,19 +90,27 @@ def parse_project(elem):
 if __name__ == "__main__":
     fpath = download_bioprojects()
 
-    # Parse all projects
+    # Parse all projects, written as JSON lines (1 project per line) while parsing
     print("Parsing bioprojects")
-    data = []
-    with open(fpath, "r") as fh:
-        for _, elem in ET.iterparse(fh, events=("end",)):
-            # Each package is a separate project, relevant data is nested within
-            # <Package><Project><Project>...</Project></Project></Package>
-            if elem.tag == "Package":
-                elem = elem.find("Project/Project")
-                project_data = parse_project(elem)
-                data.append(project_data)
-                elem.clear()
-
-    print("Saving to JSON")
-    with open(fpath.with_suffix(".json"), "w") as fh:
-        json.dump(data, fh, indent=2)
\ No newline at end of file
+    count = 0
+    with open(fpath, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            open(fpath.with_suffix(".jsonl"), "wb") as out:
+        # Each package is a separate project, relevant data is nested within
+        # <Package><Project><Project>...</Project></Project></Package>
+        # huge_tree lifts libxml2's size limits, collect_ids skips the (unused) xml:id table
+        # Comments and processing instructions are dropped, as xml.etree did
+        packages = ET.iterparse(
+            mm, events=("end",), tag="Package",
+            huge_tree=True, collect_ids=False, resolve_entities=False,
+            remove_comments=True, remove_pis=True,
+        )
+        for _, elem in packages:
+            project_data = parse_project(elem.find("Project/Project"))
+            out.write(orjson.dumps(project_data, option=orjson.OPT_APPEND_NEWLINE))
+            count += 1
+            elem.clear()
+            # Drop already parsed siblings, still referenced by the root
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    print(f"Wrote {count:,} projects to {fpath.with_suffix('.jsonl')}")
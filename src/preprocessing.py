@@ -1,11 +1,123 @@
 import ftplib
-from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+import gzip
+import mmap
+from multiprocessing import Pool
+import os
+import shutil
+import subprocess
 import tarfile
+import threading
+import urllib.error
+import urllib.request
 from pathlib import Path
+from queue import Queue, Full
 from enum import Enum
-import io
-import json
-import xml.etree.ElementTree as ET
+import orjson
+
+import sra_parsers
+from sra_parsers import KEPT_SPECIES
+
+
+def iter_in_background(iterable, maxsize=16):
+    """Iterate over iterable in a background thread, up to maxsize items ahead of the consumer
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(message):
+        # Give up once the consumer is gone
+        while not stop.is_set():
+            try:
+                queue.put(message, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(("item", item)):
+                    return
+        except BaseException as e:
+            put(("error", e))
+        else:
+            put(("done", None))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            kind, payload = queue.get()
+            if kind == "error":
+                raise payload
+            elif kind == "done":
+                return
+            yield payload
+    finally:
+        stop.set()
+        producer.join()
+
+
+def writev_all(fd, chunks):
+    """Write all chunks of bytes to a file descriptor, with a single writev() system call when available
+    """
+    total = sum(len(chunk) for chunk in chunks)
+    written = os.writev(fd, chunks) if hasattr(os, "writev") else 0
+    if written < total:  # No writev() or partial write
+        rest = memoryview(b"".join(chunks))[written:]
+        while rest:
+            rest = rest[os.write(fd, rest):]
+
+
+def write_jsonl(entries, path, maxsize=64, batch_size=64, batch_bytes=1 << 20):
+    """Write entries to a JSON lines file (1 entry per line)
+    Serialization and writing happen in a background thread, overlapping with the production of entries
+    Lines are written by batches of batch_size entries (or batch_bytes bytes) to limit system calls
+    Return the number of entries written
+    """
+    queue = Queue(maxsize=maxsize)
+    errors = []
+
+    def write():
+        try:
+            # Unbuffered: writes are already batched
+            with open(path, "wb", buffering=0) as f:
+                batch, size = [], 0
+                while (entry := queue.get()) is not None:
+                    line = orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+                    batch.append(line)
+                    size += len(line)
+                    if len(batch) >= batch_size or size >= batch_bytes:
+                        writev_all(f.fileno(), batch)
+                        batch, size = [], 0
+                writev_all(f.fileno(), batch)
+        except BaseException as e:
+            errors.append(e)
+            # Keep consuming so that the producer never blocks
+            while queue.get() is not None:
+                pass
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    count = 0
+    try:
+        for entry in entries:
+            if errors:
+                break
+            queue.put(entry)
+            count += 1
+    finally:
+        queue.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    return count
 
 
 class SRAFileType(Enum):
@@ -20,12 +132,24 @@ class SRAFileType(Enum):
 
     @classmethod
     def extract(cls, filename):
-        suffix = Path(filename).stem.split('.')[-1].upper()
-        try:
-            return cls[suffix]
-        except KeyError:
+        # Plain string operations, called for every file in the tarball (e.g. "SRA000001/SRA000001.study.xml")
+        basename = filename.rpartition('/')[2]
+        ext = basename.rfind('.')
+        suffix = basename[basename.rfind('.', 0, ext) + 1:ext]
+        file_type = SRA_FILE_TYPES.get(suffix) or SRA_FILE_TYPES.get(suffix.lower())
+        if file_type is None:
             print(f"Unknown file suffix for: {filename}")
-            return None
+        return file_type
+
+
+SRA_FILE_TYPES = {file_type.value: file_type for file_type in SRAFileType}
+
+# Parsing function for each SRA file type we extract data from, other file types are skipped
+PARSERS = {
+    "study": sra_parsers.parse_study_xml,
+    "sample": sra_parsers.parse_sample_xml,
+    "experiment": sra_parsers.parse_experiment_xml,
+}
 
 
 class SRAFileParser:
@@ -34,270 +158,443 @@ class SRAFileParser:
     (2) Parsing resulting XML files and extracting relevant fields
     (3) Saving to JSON
     """
-    def __init__(self, outdir="./sra-rag-data"):
+    def __init__(self, outdir="./sra-rag-data", species_filter=None):
+        """
+        :param outdir: Folder for the downloaded dump and the parsed data
+        :param species_filter: If set (e.g. KEPT_SPECIES), skip the titles and attributes of samples from other species
+        """
         self.ftp_root = "ftp-trace.ncbi.nlm.nih.gov"
         self.ftp_path = "/sra/reports/Metadata"
         self.outdir = Path(outdir)
         self.local_dump = None
 
+        self.parsers = dict(PARSERS)
+        if species_filter is not None:
+            self.parsers["sample"] = partial(sra_parsers.parse_sample_xml, species_filter=frozenset(species_filter))
+
     def download_sra_from_ftp(self, dump_date):
-        """Downloads SRA dump from the FTP server for the specified date
+        """Downloads SRA dump from the NCBI server for the specified date
+        Download over HTTPS (faster for large files), fall back to FTP if HTTPS is unavailable
         :param dump_date: File dump extension in SRA FTP (format: YYYYMMDD)
             Tested with '20250901'
         """
         filename = f"NCBI_SRA_Metadata_{dump_date}.tar.gz"
         local_filepath = Path(self.outdir, filename)
 
-        if not self.outdir.exists():
-            self.outdir.mkdir()
+        self.outdir.mkdir(parents=True, exist_ok=True)
 
         if not local_filepath.exists():
-            ftp = ftplib.FTP(self.ftp_root)
-            ftp.login()
-
+            # Download to a temporary file first: an interrupted download is resumed on the next run
+            partial_filepath = Path(self.outdir, f"{filename}.part")
             print(f"Downloading SRA dump")
             try:
-                ftp.retrbinary(
-                    f"RETR {self.ftp_path}/{filename}",
-                    open(local_filepath, "wb").write
-                )
-            except ftplib.error_perm as e:
+                with open(partial_filepath, "ab") as fh:
+                    try:
+                        self.retrieve_https_file(f"https://{self.ftp_root}{self.ftp_path}/{filename}", fh)
+                    except urllib.error.URLError as e:
+                        if isinstance(e, urllib.error.HTTPError) and e.code == 404:
+                            raise
+                        print(f"HTTPS download failed ({e.reason}), falling back to FTP")
+                        with ftplib.FTP(self.ftp_root) as ftp:
+                            ftp.login()
+                            ftp.set_pasv(True)
+                            self.retrieve_ftp_file(ftp, f"{self.ftp_path}/{filename}", fh)
+            except (ftplib.error_perm, urllib.error.HTTPError):
+                partial_filepath.unlink(missing_ok=True)
                 raise ValueError(
                     f"File dump not found, check {self.ftp_root}/{self.ftp_path.lstrip('/')} "
                     f"to make sure the selected dump_date is correct ({dump_date})"
                 )
+            partial_filepath.rename(local_filepath)
 
         self.local_dump = local_filepath
 
-    def iter_sra(self):
-        """Iterates over the SRA XML files in the local dump
-        Yield entries folder by folder (1 folder = 1 study = multiple XML files)
+    @staticmethod
+    def retrieve_https_file(url, fh, blocksize=1 << 20, timeout=60):
+        """Stream a file over HTTPS to fh, by blocks of blocksize bytes
+        If fh already holds the beginning of the file, only download the rest (HTTP range request)
+        """
+        offset = fh.tell()
+        request = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+        try:
+            response = urllib.request.urlopen(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            if offset and e.code == 416:  # Range not satisfiable: fh already holds the whole file
+                return
+            raise
+        with response:
+            if offset and response.status != 206:  # Range ignored by the server, restart from scratch
+                fh.truncate(0)
+            shutil.copyfileobj(response, fh, length=blocksize)
+
+    @staticmethod
+    def retrieve_ftp_file(ftp, remote_path, fh, blocksize=1 << 20):
+        """Download a file over FTP to fh, by blocks of blocksize bytes
+        If fh already holds the beginning of the file, only download the rest (FTP REST command)
+        """
+        offset = fh.tell()
+        if offset:
+            ftp.voidcmd("TYPE I")  # SIZE is only reliable in binary mode
+            if offset >= ftp.size(remote_path):
+                return
+        return ftp.retrbinary(f"RETR {remote_path}", fh.write, blocksize=blocksize, rest=offset or None)
+
+    @contextmanager
+    def open_sra_dump(self):
+        """Open the local dump as a tarball
+        Decompress with pigz (parallel gunzip) when available and stream the tarball through a pipe,
+        otherwise decompress it with gzip.GzipFile
+        In both cases a truncated or corrupt dump raises an error instead of silently ending the iteration
+        The tarball is opened in streaming mode: members can only be read in storage order
+        tarfile reads the stream by 10 KiB records by default, use 1 MiB reads instead
         """
         assert self.local_dump is not None, "SRA local dump not found, run download_sra_from_ftp() first"
 
-        files = {}
+        pigz = shutil.which("pigz")
+        if pigz is None:
+            # tarfile's own "r|gz" stream does not check the gzip end-of-stream marker, GzipFile does
+            with open(self.local_dump, "rb", buffering=1 << 20) as raw, gzip.GzipFile(fileobj=raw) as gz, \
+                    tarfile.open(fileobj=gz, mode="r|", bufsize=1 << 20) as tar:
+                yield tar
+            return
+
+        proc = subprocess.Popen([pigz, "-dc", str(self.local_dump)], stdout=subprocess.PIPE, bufsize=1 << 20)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|", bufsize=1 << 20) as tar:
+                yield tar
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"pigz failed to decompress {self.local_dump} (exit code {returncode})")
+
+    def iter_sra(self, file_types=None):
+        """Iterates over the SRA XML files in the local dump
+        Yield files one by one as (sra_id, file_type, file_obj), in tarball order (file_type as in SRAFileType values)
+        (1 folder = 1 study = multiple XML files)
+        file_obj reads directly from the tarball and is only valid until the next file is yielded
+        :param file_types: Only yield files of these types (e.g. ["study", "sample"]), default: all
+        """
+        # Filter on the member name, before paying for extractfile() and parsing
+        suffixes = ".xml" if file_types is None else tuple(f".{file_type}.xml" for file_type in file_types)
         last_sra_id = None
-        with tarfile.open(fileobj=open(self.local_dump, "rb"), mode="r:gz") as tar:
+        with self.open_sra_dump() as tar:
             for member in tar:
-                path = Path(member.name)
+                # Plain string operations rather than Path, called for every member of the tarball
+                name = member.name.rstrip("/")
 
-                if member.isdir():  # Yield previous study data
-                    if files:
-                        yield (last_sra_id, files)
-                    last_sra_id = path.name
-                    files = {}
+                if member.isdir():
+                    last_sra_id = name.rpartition("/")[2]
                     continue
 
-                elif member.name.endswith(".xml"):
-                    assert path.parent.name == last_sra_id, f"Unexpected folder structure: {member.name}"
-                    file_type = SRAFileType.extract(member.name)
-                    
-                    if file_type is not None:
-                        file_member = tar.extractfile(member)
-                        files[file_type.name.lower()] = io.BytesIO(file_member.read())
-            if files:
-                yield (last_sra_id, files)
-
-    def iterparse_sra(self):
-        """Parse SRA XML files and extract relevant fields
-        Write extracted data for each file type in a JSON file
+                elif name.endswith(suffixes):
+                    parent = name.rpartition("/")[0].rpartition("/")[2]
+                    assert parent == last_sra_id, f"Unexpected folder structure: {member.name}"
+                    if file_types is None:
+                        file_type = SRAFileType.extract(member.name)
+                        if file_type is None:
+                            continue
+                        file_type = file_type.value
+                    else:  # Already matched on the suffix (e.g. "SRA000001/SRA000001.study.xml")
+                        file_type = name[:-4].rpartition(".")[2]
+
+                    yield (last_sra_id, file_type, tar.extractfile(member))
+
+    def iter_sra_studies(self):
+        """Parse SRA XML files as they are read from the local dump
+        Yield parsed entries folder by folder as (sra_id, {file_type: parsed_data})
         """
-        for i, (sra_id, files) in enumerate(self.iter_sra(), 1):
-            if i % 1000 == 0:
-                print(f"Processed {i:,} studies", end='\r')
-
-            # Skip incomplete entries
-            if "study" not in files or "sample" not in files:
+        parsed = {}
+        last_sra_id = None
+        for sra_id, file_type, file_obj in self.iter_sra(file_types=self.parsers):
+            if sra_id != last_sra_id:  # Yield previous study data
+                if parsed:
+                    yield (last_sra_id, parsed)
+                last_sra_id = sra_id
+                parsed = {}
+
+            # Skip the remaining files of studies discarded based on their samples
+            if "sample" in parsed and not self.keep_species(parsed["sample"]["species"]):
                 continue
-            
-            study_info = self.parse_study_xml(files["study"])
-            sample_info = self.parse_sample_xml(files["sample"])
-            experiment_info = self.parse_experiment_xml(files["experiment"]) if "experiment" in files else None
 
-            species = sample_info["species"]
+            # Parse right away, file_obj is invalidated once the tarball advances
+            parsed[file_type] = self.parsers[file_type](file_obj)
+        if parsed:
+            yield (last_sra_id, parsed)
 
-            # Skip studies with <= 1 sample
-            if sum(species.values()) <= 1:
-                continue
-            # Only keep human and mouse studies
-            if not any(s in species for s in ["Homo sapiens", "Mus musculus"]):
-                continue
+    def iter_sra_bytes(self):
+        """Read SRA XML files from the local dump without parsing them
+        Yield raw entries folder by folder as (sra_id, {file_type: bytes}), picklable for worker processes
+        """
+        files = {}
+        last_sra_id = None
+        for sra_id, file_type, file_obj in self.iter_sra(file_types=self.parsers):
+            if sra_id != last_sra_id:  # Yield previous study data
+                if files:
+                    yield (last_sra_id, files)
+                last_sra_id = sra_id
+                files = {}
+
+            files[file_type] = file_obj.read()
+        if files:
+            yield (last_sra_id, files)
+
+    def index_sra_dump(self):
+        """Decompress the local dump once to an uncompressed tarball, and index the XML files we parse
+        Members of an uncompressed tarball can be read in any order, by any process, without reading the whole dump
+        Both files are kept next to the dump and reused by later runs (needs disk space for the uncompressed tarball)
+        The index has 1 line per file: name, offset of the data in the tarball, size (tab-separated)
+        :return: Paths to the uncompressed tarball and to its index
+        """
+        assert self.local_dump is not None, "SRA local dump not found, run download_sra_from_ftp() first"
 
-            yield self.format_study_data(
-                sra_id, 
-                self.aggregate_results(study_info), 
-                self.aggregate_results(sample_info), 
-                self.aggregate_results(experiment_info)
-            )
+        tar_path = Path(self.local_dump).with_suffix("")
+        index_path = tar_path.with_suffix(".members.idx")
+
+        # Write to temporary files first, so that interrupted runs are not mistaken for complete ones
+        if not tar_path.exists():
+            print(f"Decompressing {self.local_dump}")
+            partial_path = tar_path.with_name(f"{tar_path.name}.part")
+            pigz = shutil.which("pigz")
+            with open(partial_path, "wb") as fh:
+                if pigz is not None:
+                    subprocess.run([pigz, "-dc", str(self.local_dump)], stdout=fh, check=True)
+                else:
+                    with gzip.open(self.local_dump, "rb") as gz:
+                        shutil.copyfileobj(gz, fh, length=1 << 20)
+            partial_path.rename(tar_path)
+
+        if not index_path.exists():
+            print(f"Indexing {tar_path}")
+            suffixes = tuple(f".{file_type}.xml" for file_type in PARSERS)
+            partial_path = index_path.with_name(f"{index_path.name}.part")
+            # Random access mode: only member headers are read, file contents are skipped over
+            with tarfile.open(tar_path, mode="r:") as tar, open(partial_path, "w") as fh:
+                for member in tar:
+                    if member.isfile() and member.name.endswith(suffixes):
+                        fh.write(f"{member.name}\t{member.offset_data}\t{member.size}\n")
+            partial_path.rename(index_path)
+
+        return tar_path, index_path
 
     @staticmethod
-    def parse_study_xml(file_obj):
-        """Parse study.xml file for a given study
-        Keep following fields:
-        - IDENTIFIERS/{PRIMARY_ID, EXTERNAL_IDs}
-        - DESCRIPTOR/{STUDY_TITLE, STUDY_ABSTRACT, STUDY_TYPE['existing_study_type']}
+    def iter_sra_index(index_path):
+        """Read the index written by index_sra_dump()
+        Yield file locations folder by folder as (sra_id, {file_type: (offset, size)}), picklable for worker processes
+        """
+        members = {}
+        last_sra_id = None
+        with open(index_path) as fh:
+            for line in fh:
+                name, offset, size = line.rstrip("\n").split("\t")
+                # e.g. "SRA000001/SRA000001.study.xml"
+                folder, _, basename = name.rpartition("/")
+                sra_id = folder.rpartition("/")[2]
+                if sra_id != last_sra_id:  # Yield previous study data
+                    if members:
+                        yield (last_sra_id, members)
+                    last_sra_id = sra_id
+                    members = {}
+
+                members[basename[:-4].rpartition(".")[2]] = (int(offset), int(size))
+        if members:
+            yield (last_sra_id, members)
+
+    def iterparse_sra(self, processes=None, chunksize=32, prefetch=True, indexed=False):
+        """Parse SRA XML files and extract relevant fields
+        Write extracted data for each file type in a JSON file
+        :param processes: Number of worker processes parsing the XML files (default: all CPUs but one)
+        :param chunksize: Number of studies sent to a worker at once
+        :param prefetch: With processes=1, read the dump in a background thread while parsing in this one
+            If False, parse each file while it is read from the dump (lowest memory usage)
+        :param indexed: Read XML files from an uncompressed copy of the dump (see index_sra_dump(), built on first use)
+            Worker processes then read the files themselves instead of receiving them from this process
         """
-        data = {k: Counter() for k in ["SRP_ID", "bioproject", "title", "study_type", "abstract"]}
-
-        for _, elem in ET.iterparse(file_obj, events=("end",)):
-            if elem.tag == "STUDY":
-                # String fields
-                SRP_ID = elem.findtext("IDENTIFIERS/PRIMARY_ID")
-                bioproject = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='BioProject']")
-                # GSE_ID = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='GEO']")
-                title = elem.findtext("DESCRIPTOR/STUDY_TITLE")
-                abstract = elem.findtext("DESCRIPTOR/STUDY_ABSTRACT")
-                
-                # Dict field
-                study_type_elem = elem.find("DESCRIPTOR/STUDY_TYPE")
-                study_type = study_type_elem.get("existing_study_type", "") if study_type_elem is not None else ""
-
-                # Add to JSON data
-                data["SRP_ID"][SRP_ID] += 1
-                data["bioproject"][bioproject] += 1
-                data["title"][title] += 1
-                data["study_type"][study_type] += 1
-                data["abstract"][abstract] += 1
-
-                elem.clear()
-
-        return data
+        if processes is None:
+            processes = max(1, os.cpu_count() - 1)
+
+        if indexed:
+            tar_path, index_path = self.index_sra_dump()
+
+        if processes == 1:
+            if indexed:
+                _open_tarball(tar_path)
+                entries = map(partial(_parse_indexed_study, parsers=self.parsers), self.iter_sra_index(index_path))
+            elif prefetch:
+                entries = map(partial(_parse_study_files, parsers=self.parsers), iter_in_background(self.iter_sra_bytes()))
+            else:
+                entries = (self.summarize_study(sra_id, parsed) for (sra_id, parsed) in self.iter_sra_studies())
+            for i, entry in enumerate(entries, 1):
+                if i % 1000 == 0:
+                    print(f"Processed {i:,} studies", end='\r')
+                if entry is not None:
+                    yield entry
+            return
+
+        # imap_unordered consumes its input as fast as it can: bound the number of
+        # studies held in memory while waiting for a worker
+        slots = threading.Semaphore(4 * processes * chunksize)
+        stop = threading.Event()
+
+        def iter_bounded(studies):
+            for study in studies:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                yield study
+
+        if indexed:
+            worker, studies = _parse_indexed_study, self.iter_sra_index(index_path)
+            initializer, initargs = _open_tarball, (tar_path,)
+        else:
+            worker, studies = _parse_study_files, self.iter_sra_bytes()
+            initializer, initargs = None, ()
+
+        worker = partial(worker, parsers=self.parsers)
+        with Pool(processes=processes, maxtasksperchild=1000, initializer=initializer, initargs=initargs) as pool:
+            try:
+                entries = pool.imap_unordered(worker, iter_bounded(studies), chunksize=chunksize)
+                for i, entry in enumerate(entries, 1):
+                    slots.release()
+                    if i % 1000 == 0:
+                        print(f"Processed {i:,} studies", end='\r')
+                    if entry is not None:
+                        yield entry
+            finally:
+                # Unblock the reader so that the pool can shut down
+                stop.set()
+                slots.release()
 
     @staticmethod
-    def parse_sample_xml(file_obj):
-        """Parse sample.xml file for a given study
-        Keep following fields:
-        - IDENTIFIERS/{PRIMARY_ID, EXTERNAL_IDs}
-        - TITLE
-        - SAMPLE_NAME/SCIENTIFIC_NAME
-        - SAMPLE_ATTRIBUTES[List[Tuple[str, str]]]
+    def summarize_study(sra_id, parsed):
+        """Filter and format the parsed XML files of a study
+        Return None if the study is discarded
         """
-        data = {"title": Counter(), "species": Counter()}
-
-        for _, elem in ET.iterparse(file_obj, events=("end",)):
-            if elem.tag == "SAMPLE":
-                # String fields
-                # SRS_ID = elem.findtext("IDENTIFIERS/PRIMARY_ID")
-                # GSM_ID = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='GEO']")
-                # biosample = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='BioSample']")
-                title = elem.findtext("TITLE") 
-                species = elem.findtext("SAMPLE_NAME/SCIENTIFIC_NAME") or "NA"
-
-                # List field
-                sample_attributes_elem = elem.find("SAMPLE_ATTRIBUTES")  # Iterable of Tuples
-                attributes = {tag.text: ' '.join(v.text for v in value if v.text) for (tag, *value) in sample_attributes_elem} if sample_attributes_elem is not None else {}
-
-                data["species"][species] += 1
-                if title is not None:
-                    data["title"][title] += 1
-                for k, v in attributes.items():
-                    data.setdefault(k, Counter())[v] += 1
-                elem.clear()
-
-        return data
+        # Skip incomplete entries
+        if "study" not in parsed or "sample" not in parsed:
+            return None
+
+        study_info = parsed["study"]
+        sample_info = parsed["sample"]
+        experiment_info = parsed.get("experiment")
+
+        if not SRAFileParser.keep_species(sample_info["species"]):
+            return None
+
+        return SRAFileParser.format_study_data(sra_id, study_info, sample_info, experiment_info)
 
     @staticmethod
-    def parse_experiment_xml(file_obj):
-        """Parse experiment.xml file for a given study
-        Keep following fields:
-        - IDENTIFIERS/PRIMARY_ID
-        - STUDY_REF/IDENTIFIERS/{PRIMARY_ID,EXTERNAL_ID}
-        - DESIGN/SAMPLE_DESCRIPTOR/PRIMARY_ID
-        - TITLE
-        - DESIGN/DESIGN_DESCRIPTION
-        - DESIGN/LIBRARY_DESCRIPTOR/{LIBRARY_NAME,LIBRARY_STRATEGY,LIBRARY_SOURCE,LIBRARY_SELECTION,LIBRARY_LAYOUT}
-        - PLATFORM/TECHNOLOGY_FLAG/INSTRUMENT_MODEL
+    def keep_species(species):
+        """Whether to keep a study given the species of its samples (dict of species counts)
+        Skip studies with <= 1 sample, and only keep human and mouse studies
         """
-        data = {k: Counter() for k in [
-            "title", "design_description", "library_name", "library_strategy", "library_source",
-            "library_selection", "library_layout", "platform_technology", "platform_instrument"
-        ]}
-
-        for _, elem in ET.iterparse(file_obj, events=("end",)):
-            if elem.tag == "EXPERIMENT":
-                # String fields
-                # SRX_ID = elem.findtext("IDENTIFIERS/PRIMARY_ID")
-                # SRS_ID = elem.findtext("DESIGN/SAMPLE_DESCRIPTOR/PRIMARY_ID")
-                # SRP_ID = elem.findtext("STUDY_REF/IDENTIFIERS/PRIMARY_ID")
-                # bioproject = elem.findtext("STUDY_REF/IDENTIFIERS/EXTERNAL_ID[@namespace='BioProject']")
-                title = elem.findtext("TITLE")
-                design_descr = elem.findtext("DESIGN/DESIGN_DESCRIPTION")
-                library = {
-                    key:  elem.findtext(f"DESIGN/LIBRARY_DESCRIPTOR/{key}") for key in [
-                        "LIBRARY_NAME",
-                        "LIBRARY_STRATEGY",
-                        "LIBRARY_SOURCE",
-                        "LIBRARY_SELECTION",
-                    ]
-                }
-                # List field (Iterable of singleton tags)
-                library["LIBRARY_LAYOUT"] = "|".join(l.tag for l in elem.find("DESIGN/LIBRARY_DESCRIPTOR/LIBRARY_LAYOUT"))
-
-                # List field with tag extraction
-                platform_elem = elem.find("PLATFORM")
-                platform = None
-                if platform_elem is not None:
-                    if len(platform_elem) > 1:
-                        raise ValueError(f"Invalid PLATFORM element: {platform_elem}")
-
-                    platform = {
-                        "TECHNOLOGY": platform_elem[0].tag,
-                        "INSTRUMENT_MODEL": platform_elem[0].findtext("INSTRUMENT_MODEL")
-                    }
-
-                # Add to JSON data
-                if title is not None:
-                    data["title"][title] += 1
-                if design_descr is not None:
-                    data["design_description"][design_descr] += 1
-                for k, v in library.items():
-                    if v is not None:
-                        data[k.lower()][v] += 1
-                if platform is not None:
-                    data["platform_technology"][platform["TECHNOLOGY"]] += 1
-                    data["platform_instrument"][platform["INSTRUMENT_MODEL"]] += 1
-                elem.clear()
-
-        return data
+        return sum(species.values()) > 1 and any(s in species for s in KEPT_SPECIES)
+
+    # XML parsers, see sra_parsers
+    parse_sample_species_only = staticmethod(sra_parsers.parse_sample_species_only)
+    parse_study_xml = staticmethod(sra_parsers.parse_study_xml)
+    parse_sample_xml = staticmethod(sra_parsers.parse_sample_xml)
+    parse_experiment_xml = staticmethod(sra_parsers.parse_experiment_xml)
 
     @staticmethod
-    def aggregate_results(data, min_samples=10, min_count=3):
+    def aggregate_results(data, parts, min_samples=10, min_count=3, exclude=()):
         """Aggregate parsed results across all studies
+        Append one "attr: values" text line per attribute to parts
+        Attributes are either counts of each value, or a single value (counted once)
+        Values are shown with their count, e.g. "RNA-Seq(N=12)", except for values seen only once
         """
         if data is None:
-            return {}
-        summary = {}
+            return parts
         # Skip fields with too many unique values, unless there are very few samples
         for attr, count_dict in data.items():
-            if not count_dict:
+            if attr in exclude:
+                continue
+            elif not isinstance(count_dict, dict):
+                parts.append(f"{attr}: {count_dict}")
+            elif not count_dict:
                 continue
             elif attr in {"SRP_ID", "bioproject", "title"}:
-                summary[attr] = "|".join(map(str, count_dict.keys()))
-            elif max(count_dict.values()) < min_count and len(count_dict) > min_samples:
+                parts.append(f"{attr}: " + "|".join(map(str, count_dict.keys())))
+            elif len(count_dict) > min_samples and all(count < min_count for count in count_dict.values()):
                 continue
             else:
-                summary[attr] = "|".join(f"{value}(N={count})" for value, count in count_dict.items())
-        return summary
+                parts.append(f"{attr}: " + "|".join([
+                    f"{value}" if count == 1 else f"{value}(N={count})" for value, count in count_dict.items()
+                ]))
+        return parts
+
+    @staticmethod
+    def aggregate_truncated(count_dict, cap=300, with_counts=False):
+        """Aggregate a single field, stop once the result reaches cap characters
+        """
+        if not isinstance(count_dict, dict):
+            return str(count_dict)[:cap]
+
+        values = []
+        length = 0
+        for value, count in count_dict.items():
+            value = f"{value}(N={count})" if with_counts and count > 1 else str(value)
+            values.append(value)
+            length += len(value) + 1
+            if length > cap:
+                break
+        return "|".join(values)[:cap]
 
     @staticmethod
     def format_study_data(sra_id, study_info, sample_info, experiment_info=None):
-        """Format study data into a single text block and metadata dictionary
+        """Format parsed study data into a single text block and metadata dictionary
         """
-        bioproject = study_info.pop("bioproject", "")
-        srp_id = study_info.pop("SRP_ID", "")
-        species = sample_info.get("species", "").lower()
-        text = "\n".join(
-            [f"{k}: {v}" for k, v in study_info.items()] +
-            [f"{k}: {v}" for k, v in sample_info.items()] +
-            ([f"{k}: {v}" for k, v in experiment_info.items()] if experiment_info else [])
-        )
+        parts = []
+        SRAFileParser.aggregate_results(study_info, parts, exclude={"bioproject", "SRP_ID"})
+        SRAFileParser.aggregate_results(sample_info, parts)
+        SRAFileParser.aggregate_results(experiment_info, parts)
+
         metadata = dict(
             sra_id=sra_id,
-            bioproject=bioproject[:300],
-            srp_id=srp_id[:300],
-            species=species[:300],
+            bioproject=SRAFileParser.aggregate_truncated(study_info.get("bioproject", {})),
+            srp_id=SRAFileParser.aggregate_truncated(study_info.get("SRP_ID", {})),
+            species=SRAFileParser.aggregate_truncated(sample_info.get("species", {}), with_counts=True).lower(),
         )
-        return dict(text=text, metadata=metadata)
+        return dict(text="\n".join(parts), metadata=metadata)
+
+
+def _parse_study_files(study, parsers=PARSERS):
+    """Parse and summarize the raw XML files of a study, in a worker process
+    :param parsers: Parsing function for each file type (see SRAFileParser.parsers)
+    """
+    sra_id, files = study
+
+    # Skip incomplete entries, and check the species before parsing everything
+    if "study" not in files or "sample" not in files:
+        return None
+    if not SRAFileParser.parse_sample_species_only(files["sample"]):
+        return None
+
+    parsed = {file_type: parsers[file_type](data) for file_type, data in files.items()}
+    return SRAFileParser.summarize_study(sra_id, parsed)
+
+
+# Uncompressed tarball, memory-mapped once per worker process
+_tarball = None
+
+
+def _open_tarball(tar_path):
+    """Memory-map the uncompressed tarball read by _parse_indexed_study (worker process initializer)
+    """
+    global _tarball
+    with open(tar_path, "rb") as fh:
+        _tarball = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _parse_indexed_study(study, parsers=PARSERS):
+    """Same as _parse_study_files, reading the XML files at the given (offset, size) in the tarball
+    """
+    sra_id, members = study
+    files = {file_type: _tarball[offset:offset + size] for file_type, (offset, size) in members.items()}
+    return _parse_study_files((sra_id, files), parsers=parsers)
 
 
 if __name__ == "__main__":
@@ -309,17 +606,7 @@ if __name__ == "__main__":
     parser = SRAFileParser(outdir="./sra-rag-data-full")
     parser.download_sra_from_ftp(dump_date="Full_20250818")
 
-    # Loop over studies and write to JSON
-    count = 0
-    with open(f"{parser.outdir}/sra-data.json", "w", encoding="utf-8") as f:
-        f.write("[\n")
-        first = True
-        for entry in parser.iterparse_sra():
-            if not first:
-                f.write(",\n")
-            json.dump(entry, f, indent=2)
-            first = False
-            count += 1
-        f.write("\n]")
+    # Loop over studies and write to JSON lines (1 study per line)
+    count = write_jsonl(parser.iterparse_sra(), f"{parser.outdir}/sra-data.jsonl")
 
-    print(f"\nWrote {count:,} studies to {parser.outdir}/sra-data.json")
+    print(f"\nWrote {count:,} studies to {parser.outdir}/sra-data.jsonl")
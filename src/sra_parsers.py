@@ -0,0 +1,233 @@
+"""XML parsers for the files of the SRA metadata dump
+
+This is the hot path of the preprocessing: the module is plain Python so that it can be
+compiled in place with Cython (`cythonize -i -3 src/sra_parsers.py`), the compiled
+extension then takes precedence over this file on import.
+"""
+from collections import defaultdict
+import sys
+
+import lxml.etree as ET
+
+
+# Only human and mouse studies are kept
+KEPT_SPECIES = ("Homo sapiens", "Mus musculus")
+
+# Unlike xml.etree, lxml keeps comments and processing instructions as child nodes:
+# drop them, the parsers below expect elements only
+XML_PARSER = ET.XMLParser(remove_comments=True, remove_pis=True)
+
+# -- Precompiled XPath expressions for the XML parsers
+XP_STUDY = dict(
+    SRP_ID=ET.XPath("IDENTIFIERS/PRIMARY_ID"),
+    bioproject=ET.XPath("IDENTIFIERS/EXTERNAL_ID[@namespace='BioProject']"),
+    title=ET.XPath("DESCRIPTOR/STUDY_TITLE"),
+    abstract=ET.XPath("DESCRIPTOR/STUDY_ABSTRACT"),
+    study_type=ET.XPath("DESCRIPTOR/STUDY_TYPE"),
+)
+XP_SAMPLE = dict(
+    title=ET.XPath("TITLE"),
+    species=ET.XPath("SAMPLE_NAME/SCIENTIFIC_NAME"),
+    attributes=ET.XPath("SAMPLE_ATTRIBUTES"),
+)
+# Fields of LIBRARY_DESCRIPTOR collected by parse_experiment_xml()
+LIBRARY_FIELDS = {
+    "LIBRARY_NAME": "library_name",
+    "LIBRARY_STRATEGY": "library_strategy",
+    "LIBRARY_SOURCE": "library_source",
+    "LIBRARY_SELECTION": "library_selection",
+}
+
+
+def bump(counts, value):
+    """Increment the count of value in a plain dict of counts
+    """
+    counts[value] = counts.get(value, 0) + 1
+
+
+def iter_elements(source, tag):
+    """Iterate over the tag elements of an XML file, given as bytes or as a file object
+    bytes are parsed at once, file objects incrementally (parsed elements are freed along the way)
+    """
+    if isinstance(source, bytes):
+        yield from ET.fromstring(source, XML_PARSER).iter(tag)
+        return
+
+    for _, elem in ET.iterparse(source, events=("end",), tag=tag, remove_comments=True, remove_pis=True):
+        yield elem
+        elem.clear()
+        # Drop already parsed siblings, still referenced by the root
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def find(xpath, elem):
+    """Same as elem.find(), with a precompiled XPath
+    """
+    matches = xpath(elem)
+    return matches[0] if matches else None
+
+
+def findtext(xpath, elem):
+    """Same as elem.findtext(), with a precompiled XPath
+    """
+    match = find(xpath, elem)
+    return (match.text or "") if match is not None else None
+
+
+def parse_sample_species_only(source):
+    """Lightweight pass over sample.xml, same filter as SRAFileParser.keep_species()
+    Stop parsing as soon as the study is known to be kept
+    """
+    n_samples = 0
+    kept_species = False
+
+    for elem in iter_elements(source, "SAMPLE"):
+        n_samples += 1
+        kept_species = kept_species or findtext(XP_SAMPLE["species"], elem) in KEPT_SPECIES
+        if n_samples > 1 and kept_species:
+            return True
+
+    return False
+
+
+def parse_study_xml(source):
+    """Parse study.xml file for a given study
+    Keep following fields:
+    - IDENTIFIERS/{PRIMARY_ID, EXTERNAL_IDs}
+    - DESCRIPTOR/{STUDY_TITLE, STUDY_ABSTRACT, STUDY_TYPE['existing_study_type']}
+    Values are returned as is when the file has a single STUDY (almost always), as counts otherwise
+    """
+    studies = []
+
+    for elem in iter_elements(source, "STUDY"):
+        # String fields
+        SRP_ID = findtext(XP_STUDY["SRP_ID"], elem)
+        bioproject = findtext(XP_STUDY["bioproject"], elem)
+        # GSE_ID = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='GEO']")
+        title = findtext(XP_STUDY["title"], elem)
+        abstract = findtext(XP_STUDY["abstract"], elem)
+
+        # Dict field
+        study_type_elem = find(XP_STUDY["study_type"], elem)
+        study_type = study_type_elem.get("existing_study_type", "") if study_type_elem is not None else ""
+
+        # Add to JSON data
+        studies.append(dict(
+            SRP_ID=SRP_ID, bioproject=bioproject, title=title, study_type=study_type, abstract=abstract
+        ))
+
+    if len(studies) == 1:
+        return studies[0]
+
+    data = {k: {} for k in ["SRP_ID", "bioproject", "title", "study_type", "abstract"]}
+    for study in studies:
+        for k, v in study.items():
+            bump(data[k], v)
+    return data
+
+
+def parse_sample_xml(source, species_filter=None):
+    """Parse sample.xml file for a given study
+    Keep following fields:
+    - IDENTIFIERS/{PRIMARY_ID, EXTERNAL_IDs}
+    - TITLE
+    - SAMPLE_NAME/SCIENTIFIC_NAME
+    - SAMPLE_ATTRIBUTES[List[Tuple[str, str]]]
+    :param species_filter: If set (e.g. KEPT_SPECIES), only count the species of samples from other species
+    """
+    data = defaultdict(dict, title={}, species={})
+
+    for elem in iter_elements(source, "SAMPLE"):
+        # String fields
+        # SRS_ID = elem.findtext("IDENTIFIERS/PRIMARY_ID")
+        # GSM_ID = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='GEO']")
+        # biosample = elem.findtext("IDENTIFIERS/EXTERNAL_ID[@namespace='BioSample']")
+        title = findtext(XP_SAMPLE["title"], elem)
+        species = findtext(XP_SAMPLE["species"], elem) or "NA"
+
+        # Species are always counted, they decide whether the study is kept
+        bump(data["species"], species)
+        if species_filter is not None and species not in species_filter:
+            continue
+
+        # List field
+        sample_attributes_elem = find(XP_SAMPLE["attributes"], elem)  # Iterable of Tuples
+        attributes = {}
+        if sample_attributes_elem is not None:
+            for (tag, *value) in sample_attributes_elem:
+                # The same few attribute names (tissue, age, ...) repeat in every sample
+                key = sys.intern(tag.text) if tag.text else tag.text
+                attributes[key] = ' '.join(v.text for v in value if v.text)
+
+        if title is not None:
+            bump(data["title"], title)
+        for k, v in attributes.items():
+            bump(data[k], v)
+
+    return data
+
+
+def parse_experiment_xml(source):
+    """Parse experiment.xml file for a given study
+    Keep following fields:
+    - IDENTIFIERS/PRIMARY_ID
+    - STUDY_REF/IDENTIFIERS/{PRIMARY_ID,EXTERNAL_ID}
+    - DESIGN/SAMPLE_DESCRIPTOR/PRIMARY_ID
+    - TITLE
+    - DESIGN/DESIGN_DESCRIPTION
+    - DESIGN/LIBRARY_DESCRIPTOR/{LIBRARY_NAME,LIBRARY_STRATEGY,LIBRARY_SOURCE,LIBRARY_SELECTION,LIBRARY_LAYOUT}
+    - PLATFORM/TECHNOLOGY_FLAG/INSTRUMENT_MODEL
+    """
+    data = {k: {} for k in [
+        "title", "design_description", "library_name", "library_strategy", "library_source",
+        "library_selection", "library_layout", "platform_technology", "platform_instrument"
+    ]}
+
+    for elem in iter_elements(source, "EXPERIMENT"):
+        # String fields
+        # SRX_ID = elem.findtext("IDENTIFIERS/PRIMARY_ID")
+        # SRS_ID = elem.findtext("DESIGN/SAMPLE_DESCRIPTOR/PRIMARY_ID")
+        # SRP_ID = elem.findtext("STUDY_REF/IDENTIFIERS/PRIMARY_ID")
+        # bioproject = elem.findtext("STUDY_REF/IDENTIFIERS/EXTERNAL_ID[@namespace='BioProject']")
+
+        # Single pass over the children, instead of one path lookup per field
+        # Keep the first value of each field, same as findtext()
+        fields = {}
+        platform_elem = None
+        for child in elem:
+            if child.tag == "TITLE":
+                fields.setdefault("title", child.text or "")
+            elif child.tag == "DESIGN":
+                for design_child in child:
+                    if design_child.tag == "DESIGN_DESCRIPTION":
+                        fields.setdefault("design_description", design_child.text or "")
+                    elif design_child.tag == "LIBRARY_DESCRIPTOR":
+                        for library_child in design_child:
+                            if library_child.tag in LIBRARY_FIELDS:
+                                fields.setdefault(LIBRARY_FIELDS[library_child.tag], library_child.text or "")
+                            elif library_child.tag == "LIBRARY_LAYOUT":
+                                # List field (Iterable of singleton tags)
+                                fields.setdefault("library_layout", "|".join(l.tag for l in library_child))
+            elif child.tag == "PLATFORM" and platform_elem is None:
+                platform_elem = child
+
+        # List field with tag extraction
+        platform = None
+        if platform_elem is not None:
+            if len(platform_elem) > 1:
+                raise ValueError(f"Invalid PLATFORM element: {platform_elem}")
+
+            platform = {
+                "TECHNOLOGY": platform_elem[0].tag,
+                "INSTRUMENT_MODEL": platform_elem[0].findtext("INSTRUMENT_MODEL")
+            }
+
+        # Add to JSON data
+        for k, v in fields.items():
+            bump(data[k], v)
+        if platform is not None:
+            bump(data["platform_technology"], platform["TECHNOLOGY"])
+            bump(data["platform_instrument"], platform["INSTRUMENT_MODEL"])
+
+    return data
@@ -1,6 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from tqdm import tqdm
-import json
+import orjson
 
 from llama_index.core import Settings, Document, StorageContext, VectorStoreIndex
 # from llama_index.embeddings.huggingface import HuggingFaceEmbedding
@@ -8,10 +10,11 @@ from llama_index.embeddings.google_genai import GoogleGenAIEmbedding
 import chromadb
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
 
 
 # Settings.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
-Settings.embed_model = GoogleGenAIEmbedding(model_name="text-embedding-004", temperature=0.0)
+Settings.embed_model = GoogleGenAIEmbedding(model_name="text-embedding-004", temperature=0.0, embed_batch_size=100)
 
 
 def initialize_vector_store(outdir, collection_name="SRA_RAG"):
@@ -28,30 +31,48 @@ def initialize_vector_store(outdir, collection_name="SRA_RAG"):
     return vector_store, storage_context
 
 
-def build_new_index(documents_json, storage_context, chunk_size=1024, chunk_overlap=20):
-    """Build a new vector store index from the given documents JSON file.
+def build_document(entry):
+    """Build a Document from a parsed JSON line, the SRA ID is used as document ID"""
+    return Document(
+        text=entry["text"],
+        doc_id=entry["metadata"].pop("sra_id"),
+        metadata=entry["metadata"],
+    )
+
+
+def build_new_index(documents_json, storage_context, chunk_size=1024, chunk_overlap=20, batch_size=1000):
+    """Build a new vector store index from the given documents JSON lines file (1 document per line).
     For speed purposes, only include human and mouse studies.
+    The file is streamed: documents are split, embedded and written to the vector store by batches of
+    batch_size documents, the embedding model itself sends embed_batch_size texts per API request.
+    Writing a batch overlaps with embedding the next one.
     """
-    print(f"Loading raw data from {documents_json}...")
-    with open(documents_json) as f:
-        data = json.load(f)
-
-    documents = []
-    for entry in tqdm(data, desc="Building documents"):
-        doc = Document(
-            text=entry["text"],
-            doc_id=entry["metadata"].pop("sra_id"),
-            metadata=entry["metadata"],
-        )
-        documents.append(doc)
-
-    print(f"Building vector store index on ({len(documents):,} documents)...")
-    return VectorStoreIndex.from_documents(
-            documents, 
-            storage_context=storage_context,
-            transformations=[SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)],
-            show_progress=True
-        )
+    splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    vector_store = storage_context.vector_store
+    n_documents = n_nodes = 0
+
+    print(f"Building vector store index from {documents_json}...")
+    with open(documents_json, "rb") as f, ThreadPoolExecutor(max_workers=1) as writer:
+        documents = (build_document(orjson.loads(line)) for line in tqdm(f, desc="Indexing documents"))
+        pending = None
+        while batch := list(islice(documents, batch_size)):
+            nodes = splitter.get_nodes_from_documents(batch)
+
+            # Embed the same text as VectorStoreIndex would, but in large batches
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+            for node, embedding in zip(nodes, Settings.embed_model.get_text_embedding_batch(texts)):
+                node.embedding = embedding
+            if pending is not None:
+                pending.result()  # Raise write errors early, keep at most 1 batch in flight
+            pending = writer.submit(vector_store.add, nodes)
+
+            n_documents += len(batch)
+            n_nodes += len(nodes)
+        if pending is not None:
+            pending.result()
+
+    print(f"Indexed {n_documents:,} documents ({n_nodes:,} nodes)")
+    return VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context)
 
 
 def get_vector_store_index(outdir):
@@ -66,6 +87,6 @@ if __name__ == "__main__":
     # Remove '-full' for test set
     outdir = "./sra-rag-data-full"
 
-    inputs = f"{outdir}/sra-data.json"
+    inputs = f"{outdir}/sra-data.jsonl"
     vector_store, storage_context = initialize_vector_store(outdir)
     build_new_index(inputs, storage_context)
\ No newline at end of file